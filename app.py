@@ -1,27 +1,75 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, g
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException, NotFound
+from urllib.parse import urlsplit, parse_qsl, urlencode
 import os
+import gzip
+import queue
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+import orjson
+
+def _json_default(obj):
+    # Postgres NUMERIC columns come back as Decimal
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError
+
+# Postgres TIMESTAMP columns are naive UTC; give them an explicit +00:00 so
+# browsers don't read them as local time
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider backed by orjson; jsonify() responses are encoded straight to bytes"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_json_default, option=ORJSON_OPTIONS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=_json_default, option=ORJSON_OPTIONS), mimetype='application/json')
 
 app = Flask(__name__, static_folder='static')
+app.json = ORJSONProvider(app)
+# Files under /static are not fingerprinted, so cache them for a week rather than forever
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 7 * 24 * 3600
 CORS(app)
 
 # Database configuration
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
 # Use PostgreSQL (Supabase) or SQLite for local development
-if DATABASE_URL and DATABASE_URL.startswith('postgres'):
+USE_POSTGRES = bool(DATABASE_URL and DATABASE_URL.startswith('postgres'))
+
+if USE_POSTGRES:
     # PostgreSQL connection (Supabase)
-    import psycopg2
-    from psycopg2.extras import RealDictCursor
+    from psycopg2.pool import ThreadedConnectionPool
+    from psycopg2.extras import RealDictCursor, execute_values
     
-    def get_db():
-        conn = psycopg2.connect(DATABASE_URL)
-        conn.cursor_factory = RealDictCursor
-        return conn
+    # Connections are kept open and shared between requests; gunicorn.conf.py
+    # caps concurrent requests per worker at the same DB_POOL_MAX
+    db_pool = ThreadedConnectionPool(minconn=2, maxconn=int(os.environ.get('DB_POOL_MAX', 20)),
+                                     dsn=DATABASE_URL, cursor_factory=RealDictCursor)
+    
+    def acquire_db():
+        """Take a connection from the pool"""
+        return db_pool.getconn()
+    
+    def release_db(conn):
+        """Return a connection to the pool (open transactions are rolled back)"""
+        db_pool.putconn(conn)
     
     def init_db():
         """Initialize PostgreSQL tables"""
-        conn = get_db()
+        conn = acquire_db()
         cursor = conn.cursor()
         
         # Users table
@@ -30,6 +78,7 @@ if DATABASE_URL and DATABASE_URL.startswith('postgres'):
                 id BIGSERIAL PRIMARY KEY,
                 telegram_id BIGINT UNIQUE NOT NULL,
                 username TEXT,
+                data_version INTEGER NOT NULL DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
@@ -56,33 +105,78 @@ if DATABASE_URL and DATABASE_URL.startswith('postgres'):
                 amount NUMERIC(12,2) NOT NULL,
                 category TEXT NOT NULL,
                 note TEXT,
+                source_name TEXT,
+                source_type TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id),
                 FOREIGN KEY (source_id) REFERENCES money_sources (id)
             )
         ''')
         
+        # Source name/type are copied onto expenses so listing them needs no JOIN
+        cursor.execute('ALTER TABLE expenses ADD COLUMN IF NOT EXISTS source_name TEXT, ADD COLUMN IF NOT EXISTS source_type TEXT')
+        cursor.execute(Q.backfill_expense_sources)
+        
+        # Bumped on every write to a user's data; backs the ETags on GET endpoints
+        cursor.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS data_version INTEGER NOT NULL DEFAULT 0')
+        
         # Create indexes for better performance
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_id ON expenses(user_id)')
+        # (user_id, created_at) serves the per-user listings and date-range stats
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_created ON expenses(user_id, created_at DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_source ON expenses(user_id, source_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_created_at ON expenses(created_at)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_sources_user_id ON money_sources(user_id)')
+        # Covered by the composite indexes above
+        cursor.execute('DROP INDEX IF EXISTS idx_expenses_user_id')
         
         conn.commit()
-        conn.close()
+        release_db(conn)
 else:
     # SQLite for local development
     import sqlite3
     
     DATABASE = 'finance.db'
     
-    def get_db():
-        conn = sqlite3.connect(DATABASE)
-        conn.row_factory = sqlite3.Row
+    # Applied once to each new connection: WAL lets readers run during writes,
+    # NORMAL sync skips the per-commit fsync of the WAL, mmap avoids read() calls
+    SQLITE_PRAGMAS = (
+        'journal_mode=WAL',
+        'synchronous=NORMAL',
+        'mmap_size=268435456',
+        'cache_size=-65536',
+        'temp_store=MEMORY',
+        'foreign_keys=ON',
+    )
+    
+    def dict_factory(cursor, row):
+        """Build plain dicts straight from SQLite rows, like RealDictCursor on Postgres"""
+        return {column[0]: value for column, value in zip(cursor.description, row)}
+    
+    # Idle connections shared by the whole process rather than tied to a thread,
+    # since the development server starts a new thread for every request. LIFO
+    # hands out the most recently used connection, whose cache is warmest.
+    _idle = queue.LifoQueue()
+    
+    def acquire_db():
+        """Take an idle connection, opening a new one only if none is free"""
+        try:
+            return _idle.get_nowait()
+        except queue.Empty:
+            pass
+        conn = sqlite3.connect(DATABASE, check_same_thread=False)
+        conn.row_factory = dict_factory
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(f'PRAGMA {pragma}')
         return conn
     
+    def release_db(conn):
+        """Keep the connection open for reuse, discarding any uncommitted changes"""
+        conn.rollback()
+        _idle.put(conn)
+    
     def init_db():
         """Initialize SQLite tables"""
-        conn = get_db()
+        conn = acquire_db()
         cursor = conn.cursor()
         
         # Users table
@@ -91,6 +185,7 @@ else:
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 telegram_id INTEGER UNIQUE NOT NULL,
                 username TEXT,
+                data_version INTEGER NOT NULL DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
@@ -117,50 +212,255 @@ else:
                 amount REAL NOT NULL,
                 category TEXT NOT NULL,
                 note TEXT,
+                source_name TEXT,
+                source_type TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id),
                 FOREIGN KEY (source_id) REFERENCES money_sources (id)
             )
         ''')
         
+        # Source name/type are copied onto expenses so listing them needs no JOIN
+        columns = {row['name'] for row in cursor.execute('PRAGMA table_info(expenses)')}
+        for column in ('source_name', 'source_type'):
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE expenses ADD COLUMN {column} TEXT')
+        cursor.execute(Q.backfill_expense_sources)
+        
+        # Bumped on every write to a user's data; backs the ETags on GET endpoints
+        columns = {row['name'] for row in cursor.execute('PRAGMA table_info(users)')}
+        if 'data_version' not in columns:
+            cursor.execute('ALTER TABLE users ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0')
+        
+        # Create indexes for better performance
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_created ON expenses(user_id, created_at DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_source ON expenses(user_id, source_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sources_user_id ON money_sources(user_id)')
+        
         conn.commit()
-        conn.close()
+        release_db(conn)
 
-# Helper function to convert Row/RealDictRow to dict
-def row_to_dict(row):
-    """Convert database row to dictionary"""
-    if row is None:
-        return None
-    if isinstance(row, dict):
-        return row
-    return dict(row)
+def get_db():
+    """Get the connection bound to the current request"""
+    if 'db' not in g:
+        g.db = acquire_db()
+    return g.db
+
+@app.teardown_appcontext
+def teardown_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        release_db(conn)
+
+# SQL statements are written with SQLite's ? placeholders; psycopg2 wants %s
+def _sql(query):
+    return query.replace('?', '%s') if USE_POSTGRES else query
+
+class Q:
+    """SQL statements for the active dialect, resolved once at import"""
+    
+    upsert_user = _sql('''
+        INSERT INTO users (telegram_id, username) VALUES (?, ?)
+        ON CONFLICT (telegram_id) DO UPDATE SET username = COALESCE(excluded.username, users.username)
+        RETURNING id
+    ''')
+    
+    get_data_version = _sql('SELECT data_version FROM users WHERE id = ?')
+    bump_data_version = _sql('UPDATE users SET data_version = data_version + 1 WHERE id = ?')
+    
+    # Money sources
+    get_sources = _sql('SELECT * FROM money_sources WHERE user_id = ? ORDER BY created_at DESC')
+    insert_source = _sql('INSERT INTO money_sources (user_id, name, balance, type) VALUES (?, ?, ?, ?) RETURNING id')
+    update_source_balance = _sql('UPDATE money_sources SET balance = ? WHERE id = ? AND user_id = ?')
+    count_source_expenses = _sql('SELECT COUNT(*) as count FROM expenses WHERE source_id = ? AND user_id = ?')
+    delete_source = _sql('DELETE FROM money_sources WHERE id = ? AND user_id = ?')
+    source_exists = _sql('SELECT 1 FROM money_sources WHERE id = ? AND user_id = ?')
+    
+    # Expenses (source_name/source_type are stored on each row, see init_db)
+    get_expenses = _sql('SELECT * FROM expenses WHERE user_id = ? ORDER BY created_at DESC LIMIT ?')
+    backfill_expense_sources = '''
+        UPDATE expenses SET
+            source_name = (SELECT name FROM money_sources WHERE money_sources.id = expenses.source_id),
+            source_type = (SELECT type FROM money_sources WHERE money_sources.id = expenses.source_id)
+        WHERE source_name IS NULL
+    '''
+    # Postgres: debit the source only if it covers the amount, then record the expense
+    debit_and_insert_expense = _sql('''
+        WITH debited AS (
+            UPDATE money_sources SET balance = balance - ?
+            WHERE id = ? AND user_id = ? AND balance >= ?
+            RETURNING id, name, type
+        )
+        INSERT INTO expenses (user_id, source_id, amount, category, note, source_name, source_type)
+        SELECT ?, id, ?, ?, ?, name, type FROM debited
+        RETURNING id
+    ''')
+    # SQLite cannot UPDATE inside a CTE, so the same happens in two statements
+    debit_source = _sql('UPDATE money_sources SET balance = balance - ? WHERE id = ? AND user_id = ? AND balance >= ? RETURNING id, name, type')
+    insert_expense = _sql('INSERT INTO expenses (user_id, source_id, amount, category, note, source_name, source_type) VALUES (?, ?, ?, ?, ?, ?, ?)')
+    # Postgres bulk variants, expanded by psycopg2's execute_values
+    bulk_debit_sources = '''
+        UPDATE money_sources AS ms SET balance = ms.balance - s.total
+        FROM (VALUES %s) AS s(id, total, user_id)
+        WHERE ms.id = s.id AND ms.user_id = s.user_id AND ms.balance >= s.total
+        RETURNING ms.id, ms.name, ms.type
+    '''
+    bulk_insert_expenses = 'INSERT INTO expenses (user_id, source_id, amount, category, note, source_name, source_type) VALUES %s'
+    get_expense = _sql('SELECT amount, source_id FROM expenses WHERE id = ? AND user_id = ?')
+    credit_source = _sql('UPDATE money_sources SET balance = balance + ? WHERE id = ?')
+    delete_expense = _sql('DELETE FROM expenses WHERE id = ? AND user_id = ?')
+    
+    # Statistics (bare created_at ranges so the (user_id, created_at) index applies)
+    month_range = (
+        "created_at >= DATE_TRUNC('month', CURRENT_DATE) AND created_at < DATE_TRUNC('month', CURRENT_DATE) + INTERVAL '1 month'"
+        if USE_POSTGRES else
+        "created_at >= date('now', 'start of month') AND created_at < date('now', 'start of month', '+1 month')"
+    )
+    monthly_by_category = _sql(f'''
+        SELECT category, SUM(amount) as total
+        FROM expenses
+        WHERE user_id = ? AND {month_range}
+        GROUP BY category
+        ORDER BY total DESC
+    ''')
+    week_start = "CURRENT_DATE - INTERVAL '7 days'" if USE_POSTGRES else "date('now', '-7 days')"
+    weekly_by_day = _sql(f'''
+        SELECT DATE(created_at) as date, SUM(amount) as total
+        FROM expenses
+        WHERE user_id = ? AND created_at >= {week_start}
+        GROUP BY DATE(created_at)
+        ORDER BY date ASC
+    ''')
+    spending_by_source = _sql('''
+        SELECT ms.name, ms.balance, SUM(e.amount) as spent
+        FROM money_sources ms
+        LEFT JOIN expenses e ON ms.id = e.source_id
+        WHERE ms.user_id = ?
+        GROUP BY ms.id, ms.name, ms.balance
+        ORDER BY spent DESC
+    ''')
+
+class UserNotFound(NotFound):
+    description = 'User not found'
+
+@app.errorhandler(UserNotFound)
+def user_not_found(e):
+    return jsonify({'error': e.description}), 404
+
+# telegram_id -> user_id, filled on first sight (user ids never change)
+USER_CACHE_SIZE = 10000
+_user_ids = {}
+_user_ids_lock = threading.Lock()
 
 # Create or get user
 def get_or_create_user(telegram_id, username=None):
+    key = str(telegram_id)
+    
+    # Known users skip the database unless there is a username to store
+    if username is None:
+        user_id = _user_ids.get(key)
+        if user_id is not None:
+            return user_id
+    
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute('SELECT * FROM users WHERE telegram_id = %s' if DATABASE_URL else 'SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
-    user = cursor.fetchone()
+    # Insert the user or touch the existing row; either way RETURNING gives the id
+    cursor.execute(Q.upsert_user, (telegram_id, username))
+    user_id = cursor.fetchone()['id']
+    conn.commit()
     
-    if not user:
-        cursor.execute('INSERT INTO users (telegram_id, username) VALUES (%s, %s) RETURNING id' if DATABASE_URL else 'INSERT INTO users (telegram_id, username) VALUES (?, ?)',
-                      (telegram_id, username))
-        conn.commit()
-        if DATABASE_URL:
-            user_id = cursor.fetchone()['id']
-        else:
-            user_id = cursor.lastrowid
-    else:
-        user_id = user['id']
+    with _user_ids_lock:
+        if key not in _user_ids and len(_user_ids) >= USER_CACHE_SIZE:
+            # Evict the oldest entry
+            del _user_ids[next(iter(_user_ids))]
+        _user_ids[key] = user_id
     
-    conn.close()
     return user_id
 
+# Statistics responses per user, one entry per endpoint tagged with the period
+# it covers (month or day), so a new period replaces the old entry. The cache is
+# per process, so each entry also remembers the users.data_version it was built
+# from and is only served while that is still current; writes in any worker bump it.
+STATS_CACHE_TTL = 300
+STATS_CACHE_SIZE = 4096
+_stats_cache = {}
+_stats_cache_lock = threading.Lock()
+
+def get_cached_stats(user_id, endpoint, period, version):
+    """Return a cached statistics payload, or None if missing, expired or outdated"""
+    with _stats_cache_lock:
+        entry = _stats_cache.get(user_id, {}).get(endpoint)
+    if entry and entry[0] > time.monotonic() and entry[1:3] == (period, version):
+        return entry[3]
+    return None
+
+def cache_stats(user_id, endpoint, period, version, payload):
+    with _stats_cache_lock:
+        if user_id not in _stats_cache and len(_stats_cache) >= STATS_CACHE_SIZE:
+            # Evict the oldest user
+            del _stats_cache[next(iter(_stats_cache))]
+        _stats_cache.setdefault(user_id, {})[endpoint] = (time.monotonic() + STATS_CACHE_TTL, period, version, payload)
+
+def invalidate_stats(user_id):
+    with _stats_cache_lock:
+        _stats_cache.pop(user_id, None)
+
+# users.data_version is bumped by every write in its own transaction, so it
+# tells any worker process whether its cached view of a user is still current
+def get_data_version(cursor, user_id):
+    cursor.execute(Q.get_data_version, (user_id,))
+    row = cursor.fetchone()
+    if row is None:
+        # The cached id points at a user row that is gone; the next request recreates it
+        with _user_ids_lock:
+            for key in [key for key, cached_id in _user_ids.items() if cached_id == user_id]:
+                del _user_ids[key]
+        raise UserNotFound()
+    return row['data_version']
+
+# Conditional GETs: the ETag is built from the user's data_version
+def data_etag(cursor, user_id, *parts):
+    version = get_data_version(cursor, user_id)
+    return '-'.join(str(part) for part in (user_id, version) + parts)
+
+def with_etag(response, etag):
+    """Let the browser keep the response but revalidate it before every reuse"""
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# index.html held in memory (plain and gzipped) and re-read only when the file changes
+INDEX_PATH = os.path.join(app.static_folder, 'index.html')
+_index = None
+
+def load_index():
+    """Return (mtime, body, gzipped body, etag) for index.html"""
+    global _index
+    mtime = os.path.getmtime(INDEX_PATH)
+    if _index is None or _index[0] != mtime:
+        with open(INDEX_PATH, 'rb') as f:
+            body = f.read()
+        _index = (mtime, body, gzip.compress(body), hashlib.sha1(body).hexdigest())
+    return _index
+
 # Routes
 @app.route('/')
 def index():
-    return send_from_directory('static', 'index.html')
+    _, body, gzipped, etag = load_index()
+    
+    use_gzip = request.accept_encodings['gzip'] > 0
+    response = app.response_class(gzipped if use_gzip else body, mimetype='text/html')
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+        etag += '-gz'
+    response.headers['Vary'] = 'Accept-Encoding'
+    
+    # Browsers revalidate on every load and get a body-less 304 while unchanged
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/api/init', methods=['POST'])
 def init_user():
@@ -186,13 +486,15 @@ def get_sources():
     
     user_id = get_or_create_user(telegram_id)
     
-    query = 'SELECT * FROM money_sources WHERE user_id = %s ORDER BY created_at DESC' if DATABASE_URL else 'SELECT * FROM money_sources WHERE user_id = ? ORDER BY created_at DESC'
-    cursor.execute(query, (user_id,))
+    etag = data_etag(cursor, user_id, 'sources')
+    if request.if_none_match.contains_weak(etag):
+        return with_etag(app.response_class(status=304), etag)
+    
+    cursor.execute(Q.get_sources, (user_id,))
     
-    sources = [row_to_dict(row) for row in cursor.fetchall()]
-    conn.close()
+    sources = cursor.fetchall()
     
-    return jsonify(sources)
+    return with_etag(jsonify(sources), etag)
 
 @app.route('/api/sources', methods=['POST'])
 def add_source():
@@ -210,17 +512,12 @@ def add_source():
     
     user_id = get_or_create_user(telegram_id)
     
-    query = 'INSERT INTO money_sources (user_id, name, balance, type) VALUES (%s, %s, %s, %s) RETURNING id' if DATABASE_URL else 'INSERT INTO money_sources (user_id, name, balance, type) VALUES (?, ?, ?, ?)'
-    cursor.execute(query, (user_id, name, balance, source_type))
+    cursor.execute(Q.insert_source, (user_id, name, balance, source_type))
+    source_id = cursor.fetchone()['id']
     
+    cursor.execute(Q.bump_data_version, (user_id,))
     conn.commit()
-    
-    if DATABASE_URL:
-        source_id = cursor.fetchone()['id']
-    else:
-        source_id = cursor.lastrowid
-    
-    conn.close()
+    invalidate_stats(user_id)
     
     return jsonify({
         'id': source_id,
@@ -241,11 +538,11 @@ def update_source(source_id):
     
     user_id = get_or_create_user(telegram_id)
     
-    query = 'UPDATE money_sources SET balance = %s WHERE id = %s AND user_id = %s' if DATABASE_URL else 'UPDATE money_sources SET balance = ? WHERE id = ? AND user_id = ?'
-    cursor.execute(query, (balance, source_id, user_id))
+    cursor.execute(Q.update_source_balance, (balance, source_id, user_id))
     
+    cursor.execute(Q.bump_data_version, (user_id,))
     conn.commit()
-    conn.close()
+    invalidate_stats(user_id)
     
     return jsonify({'message': 'Source updated successfully'})
 
@@ -262,59 +559,52 @@ def delete_source(source_id):
     user_id = get_or_create_user(telegram_id)
     
     # Check if source has any expenses
-    query = 'SELECT COUNT(*) as count FROM expenses WHERE source_id = %s AND user_id = %s' if DATABASE_URL else 'SELECT COUNT(*) as count FROM expenses WHERE source_id = ? AND user_id = ?'
-    cursor.execute(query, (source_id, user_id))
+    cursor.execute(Q.count_source_expenses, (source_id, user_id))
     
     expense_count = cursor.fetchone()['count']
     
     if expense_count > 0:
-        conn.close()
         return jsonify({'error': f'Cannot delete source with {expense_count} expenses. Delete expenses first.'}), 400
     
-    query = 'DELETE FROM money_sources WHERE id = %s AND user_id = %s' if DATABASE_URL else 'DELETE FROM money_sources WHERE id = ? AND user_id = ?'
-    cursor.execute(query, (source_id, user_id))
+    cursor.execute(Q.delete_source, (source_id, user_id))
     
+    cursor.execute(Q.bump_data_version, (user_id,))
     conn.commit()
-    conn.close()
+    invalidate_stats(user_id)
     
     return jsonify({'message': 'Source deleted successfully'})
 
 # Expenses endpoints
+MAX_EXPENSES_LIMIT = 500
+MAX_BULK_EXPENSES = 1000
+
 @app.route('/api/expenses', methods=['GET'])
 def get_expenses():
     telegram_id = request.args.get('telegram_id')
-    limit = request.args.get('limit', 50)
     
     if not telegram_id:
         return jsonify({'error': 'telegram_id is required'}), 400
     
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    limit = max(1, min(limit, MAX_EXPENSES_LIMIT))
+    
     conn = get_db()
     cursor = conn.cursor()
     
     user_id = get_or_create_user(telegram_id)
     
-    query = '''
-        SELECT e.*, ms.name as source_name, ms.type as source_type
-        FROM expenses e
-        JOIN money_sources ms ON e.source_id = ms.id
-        WHERE e.user_id = %s
-        ORDER BY e.created_at DESC
-        LIMIT %s
-    ''' if DATABASE_URL else '''
-        SELECT e.*, ms.name as source_name, ms.type as source_type
-        FROM expenses e
-        JOIN money_sources ms ON e.source_id = ms.id
-        WHERE e.user_id = ?
-        ORDER BY e.created_at DESC
-        LIMIT ?
-    '''
+    etag = data_etag(cursor, user_id, 'expenses', limit)
+    if request.if_none_match.contains_weak(etag):
+        return with_etag(app.response_class(status=304), etag)
     
-    cursor.execute(query, (user_id, limit))
+    cursor.execute(Q.get_expenses, (user_id, limit))
     
-    expenses = [row_to_dict(row) for row in cursor.fetchall()]
-    conn.close()
+    expenses = cursor.fetchall()
     
-    return jsonify(expenses)
+    return with_etag(jsonify(expenses), etag)
 
 @app.route('/api/expenses', methods=['POST'])
 def add_expense():
@@ -333,39 +623,128 @@ def add_expense():
     
     user_id = get_or_create_user(telegram_id)
     
-    # Check if source exists and has enough balance
-    query = 'SELECT balance FROM money_sources WHERE id = %s AND user_id = %s' if DATABASE_URL else 'SELECT balance FROM money_sources WHERE id = ? AND user_id = ?'
-    cursor.execute(query, (source_id, user_id))
-    source = cursor.fetchone()
+    # Debit the source only if it covers the amount, then record the expense
+    if USE_POSTGRES:
+        cursor.execute(Q.debit_and_insert_expense, (amount, source_id, user_id, amount, user_id, amount, category, note))
+        row = cursor.fetchone()
+        expense_id = row['id'] if row else None
+    else:
+        cursor.execute(Q.debit_source, (amount, source_id, user_id, amount))
+        source = cursor.fetchone()
+        expense_id = None
+        if source:
+            cursor.execute(Q.insert_expense, (user_id, source_id, amount, category, note, source['name'], source['type']))
+            expense_id = cursor.lastrowid
+    
+    if expense_id is None:
+        conn.rollback()
+        # Nothing was debited: tell a missing source apart from a short balance
+        cursor.execute(Q.source_exists, (source_id, user_id))
+        if not cursor.fetchone():
+            return jsonify({'error': 'Source not found'}), 404
+        return jsonify({'error': 'Insufficient balance'}), 400
     
-    if not source:
-        conn.close()
-        return jsonify({'error': 'Source not found'}), 404
+    cursor.execute(Q.bump_data_version, (user_id,))
+    conn.commit()
+    invalidate_stats(user_id)
     
-    if float(source['balance']) < float(amount):
-        conn.close()
-        return jsonify({'error': 'Insufficient balance'}), 400
+    return jsonify({
+        'id': expense_id,
+        'message': 'Expense added successfully'
+    }), 201
+
+def parse_bulk_expense(e):
+    """Return (source_id, amount, category, note) for one bulk item, or None if invalid"""
+    if not isinstance(e, dict):
+        return None
+    source_id = e.get('source_id')
+    amount = e.get('amount')
+    category = e.get('category')
+    note = e.get('note', '')
     
-    # Add expense
-    query = 'INSERT INTO expenses (user_id, source_id, amount, category, note) VALUES (%s, %s, %s, %s, %s) RETURNING id' if DATABASE_URL else 'INSERT INTO expenses (user_id, source_id, amount, category, note) VALUES (?, ?, ?, ?, ?)'
-    cursor.execute(query, (user_id, source_id, amount, category, note))
+    # bool is a subclass of int, so True/False must be ruled out explicitly
+    if not isinstance(source_id, int) or isinstance(source_id, bool):
+        return None
+    if isinstance(amount, bool) or not isinstance(amount, (int, float, str)):
+        return None
+    try:
+        amount = float(amount)
+    except ValueError:
+        return None
+    if not (math.isfinite(amount) and amount > 0):
+        return None
+    if not isinstance(category, str) or not category:
+        return None
+    if note is not None and not isinstance(note, str):
+        return None
+    return source_id, amount, category, note
+
+@app.route('/api/expenses/bulk', methods=['POST'])
+def add_expenses_bulk():
+    """Add many expenses in one transaction; either all are recorded or none.
     
-    # Update source balance
-    query = 'UPDATE money_sources SET balance = balance - %s WHERE id = %s' if DATABASE_URL else 'UPDATE money_sources SET balance = balance - ? WHERE id = ?'
-    cursor.execute(query, (amount, source_id))
+    Body: {"telegram_id": ..., "expenses": [{"source_id", "amount", "category", "note"}, ...]}
+    """
+    data = request.json
+    telegram_id = data.get('telegram_id')
+    items = data.get('expenses') or []
     
-    conn.commit()
+    if not telegram_id or not items:
+        return jsonify({'error': 'telegram_id and expenses are required'}), 400
+    
+    if not isinstance(items, list):
+        return jsonify({'error': 'expenses must be a list'}), 400
+    
+    if len(items) > MAX_BULK_EXPENSES:
+        return jsonify({'error': f'At most {MAX_BULK_EXPENSES} expenses per request'}), 400
+    
+    items = [parse_bulk_expense(e) for e in items]
+    if None in items:
+        return jsonify({'error': 'Missing or invalid fields'}), 400
     
-    if DATABASE_URL:
-        expense_id = cursor.fetchone()['id']
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    user_id = get_or_create_user(telegram_id)
+    
+    # Debit each source once with its total, only if the balance covers it.
+    # Sum as Decimal so e.g. 0.1 + 0.2 matches a balance of 0.30 exactly.
+    totals = {}
+    for source_id, amount, _, _ in items:
+        totals[source_id] = totals.get(source_id, 0) + Decimal(str(amount))
+    
+    if USE_POSTGRES:
+        debited = execute_values(cursor, Q.bulk_debit_sources,
+                                 [(source_id, total, user_id) for source_id, total in totals.items()], fetch=True)
     else:
-        expense_id = cursor.lastrowid
+        debited = []
+        for source_id, total in totals.items():
+            total = float(total)
+            cursor.execute(Q.debit_source, (total, source_id, user_id, total))
+            debited.extend(cursor.fetchall())
+    
+    sources = {row['id']: row for row in debited}
+    failed = [source_id for source_id in totals if source_id not in sources]
+    if failed:
+        conn.rollback()
+        return jsonify({'error': 'Source not found or insufficient balance', 'source_ids': failed}), 400
+    
+    rows = [
+        (user_id, source_id, amount, category, note, sources[source_id]['name'], sources[source_id]['type'])
+        for source_id, amount, category, note in items
+    ]
+    if USE_POSTGRES:
+        execute_values(cursor, Q.bulk_insert_expenses, rows)
+    else:
+        cursor.executemany(Q.insert_expense, rows)
     
-    conn.close()
+    cursor.execute(Q.bump_data_version, (user_id,))
+    conn.commit()
+    invalidate_stats(user_id)
     
     return jsonify({
-        'id': expense_id,
-        'message': 'Expense added successfully'
+        'count': len(rows),
+        'message': 'Expenses added successfully'
     }), 201
 
 @app.route('/api/expenses/<int:expense_id>', methods=['DELETE'])
@@ -381,25 +760,22 @@ def delete_expense(expense_id):
     user_id = get_or_create_user(telegram_id)
     
     # Get expense details before deleting
-    query = 'SELECT amount, source_id FROM expenses WHERE id = %s AND user_id = %s' if DATABASE_URL else 'SELECT amount, source_id FROM expenses WHERE id = ? AND user_id = ?'
-    cursor.execute(query, (expense_id, user_id))
+    cursor.execute(Q.get_expense, (expense_id, user_id))
     
     expense = cursor.fetchone()
     
     if not expense:
-        conn.close()
         return jsonify({'error': 'Expense not found'}), 404
     
     # Restore balance to source
-    query = 'UPDATE money_sources SET balance = balance + %s WHERE id = %s' if DATABASE_URL else 'UPDATE money_sources SET balance = balance + ? WHERE id = ?'
-    cursor.execute(query, (expense['amount'], expense['source_id']))
+    cursor.execute(Q.credit_source, (expense['amount'], expense['source_id']))
     
     # Delete expense
-    query = 'DELETE FROM expenses WHERE id = %s AND user_id = %s' if DATABASE_URL else 'DELETE FROM expenses WHERE id = ? AND user_id = ?'
-    cursor.execute(query, (expense_id, user_id))
+    cursor.execute(Q.delete_expense, (expense_id, user_id))
     
+    cursor.execute(Q.bump_data_version, (user_id,))
     conn.commit()
-    conn.close()
+    invalidate_stats(user_id)
     
     return jsonify({'message': 'Expense deleted and balance restored'})
 
@@ -411,59 +787,31 @@ def get_monthly_statistics():
     if not telegram_id:
         return jsonify({'error': 'telegram_id is required'}), 400
     
+    user_id = get_or_create_user(telegram_id)
+    
     conn = get_db()
     cursor = conn.cursor()
     
-    user_id = get_or_create_user(telegram_id)
+    period = datetime.now(timezone.utc).strftime('%Y%m')
+    version = get_data_version(cursor, user_id)
+    stats = get_cached_stats(user_id, 'monthly', period, version)
+    if stats is not None:
+        return jsonify(stats)
     
     # Get current month's expenses by category
-    if DATABASE_URL:
-        query = '''
-            SELECT category, SUM(amount) as total
-            FROM expenses
-            WHERE user_id = %s 
-            AND DATE_TRUNC('month', created_at) = DATE_TRUNC('month', CURRENT_DATE)
-            GROUP BY category
-            ORDER BY total DESC
-        '''
-    else:
-        query = '''
-            SELECT category, SUM(amount) as total
-            FROM expenses
-            WHERE user_id = ? 
-            AND strftime('%Y-%m', created_at) = strftime('%Y-%m', 'now')
-            GROUP BY category
-            ORDER BY total DESC
-        '''
-    
-    cursor.execute(query, (user_id,))
-    categories = [row_to_dict(row) for row in cursor.fetchall()]
-    
-    # Get total for current month
-    if DATABASE_URL:
-        query = '''
-            SELECT SUM(amount) as total
-            FROM expenses
-            WHERE user_id = %s 
-            AND DATE_TRUNC('month', created_at) = DATE_TRUNC('month', CURRENT_DATE)
-        '''
-    else:
-        query = '''
-            SELECT SUM(amount) as total
-            FROM expenses
-            WHERE user_id = ? 
-            AND strftime('%Y-%m', created_at) = strftime('%Y-%m', 'now')
-        '''
-    
-    cursor.execute(query, (user_id,))
-    total = cursor.fetchone()['total'] or 0
+    cursor.execute(Q.monthly_by_category, (user_id,))
+    categories = cursor.fetchall()
     
-    conn.close()
+    # Month total is the sum of the category totals (Decimal on Postgres, so sum before converting)
+    total = sum(row['total'] for row in categories)
     
-    return jsonify({
+    stats = {
         'categories': categories,
         'total': float(total)
-    })
+    }
+    cache_stats(user_id, 'monthly', period, version, stats)
+    
+    return jsonify(stats)
 
 @app.route('/api/statistics/weekly', methods=['GET'])
 def get_weekly_statistics():
@@ -472,36 +820,25 @@ def get_weekly_statistics():
     if not telegram_id:
         return jsonify({'error': 'telegram_id is required'}), 400
     
+    user_id = get_or_create_user(telegram_id)
+    
     conn = get_db()
     cursor = conn.cursor()
     
-    user_id = get_or_create_user(telegram_id)
+    period = datetime.now(timezone.utc).strftime('%Y%m%d')
+    version = get_data_version(cursor, user_id)
+    stats = get_cached_stats(user_id, 'weekly', period, version)
+    if stats is not None:
+        return jsonify(stats)
     
     # Get last 7 days expenses
-    if DATABASE_URL:
-        query = '''
-            SELECT DATE(created_at) as date, SUM(amount) as total
-            FROM expenses
-            WHERE user_id = %s 
-            AND created_at >= CURRENT_DATE - INTERVAL '7 days'
-            GROUP BY DATE(created_at)
-            ORDER BY date ASC
-        '''
-    else:
-        query = '''
-            SELECT DATE(created_at) as date, SUM(amount) as total
-            FROM expenses
-            WHERE user_id = ? 
-            AND created_at >= date('now', '-7 days')
-            GROUP BY DATE(created_at)
-            ORDER BY date ASC
-        '''
+    cursor.execute(Q.weekly_by_day, (user_id,))
+    daily = cursor.fetchall()
     
-    cursor.execute(query, (user_id,))
-    daily = [row_to_dict(row) for row in cursor.fetchall()]
-    conn.close()
+    stats = {'daily': daily}
+    cache_stats(user_id, 'weekly', period, version, stats)
     
-    return jsonify({'daily': daily})
+    return jsonify(stats)
 
 @app.route('/api/statistics/sources', methods=['GET'])
 def get_source_statistics():
@@ -510,37 +847,80 @@ def get_source_statistics():
     if not telegram_id:
         return jsonify({'error': 'telegram_id is required'}), 400
     
+    user_id = get_or_create_user(telegram_id)
+    
     conn = get_db()
     cursor = conn.cursor()
     
-    user_id = get_or_create_user(telegram_id)
+    version = get_data_version(cursor, user_id)
+    stats = get_cached_stats(user_id, 'sources', None, version)
+    if stats is not None:
+        return jsonify(stats)
     
     # Get spending by source
-    query = '''
-        SELECT ms.name, ms.balance, SUM(e.amount) as spent
-        FROM money_sources ms
-        LEFT JOIN expenses e ON ms.id = e.source_id
-        WHERE ms.user_id = %s
-        GROUP BY ms.id, ms.name, ms.balance
-        ORDER BY spent DESC
-    ''' if DATABASE_URL else '''
-        SELECT ms.name, ms.balance, SUM(e.amount) as spent
-        FROM money_sources ms
-        LEFT JOIN expenses e ON ms.id = e.source_id
-        WHERE ms.user_id = ?
-        GROUP BY ms.id
-        ORDER BY spent DESC
-    '''
+    cursor.execute(Q.spending_by_source, (user_id,))
+    sources = cursor.fetchall()
     
-    cursor.execute(query, (user_id,))
-    sources = [row_to_dict(row) for row in cursor.fetchall()]
-    conn.close()
+    stats = {'sources': sources}
+    cache_stats(user_id, 'sources', None, version, stats)
     
-    return jsonify({'sources': sources})
+    return jsonify(stats)
+
+# Batch endpoint
+MAX_BATCH_REQUESTS = 20
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """Run several GET endpoints in one HTTP round-trip.
+    
+    Body: {"telegram_id": ..., "requests": ["/api/sources", "/api/expenses?limit=20", ...]}
+    Sub-requests share this request's database connection.
+    """
+    data = request.json
+    telegram_id = data.get('telegram_id')
+    paths = data.get('requests') or []
+    
+    if not telegram_id:
+        return jsonify({'error': 'telegram_id is required'}), 400
+    
+    if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+        return jsonify({'error': 'requests must be a list of paths'}), 400
+    
+    if len(paths) > MAX_BATCH_REQUESTS:
+        return jsonify({'error': f'At most {MAX_BATCH_REQUESTS} requests per batch'}), 400
+    
+    responses = []
+    for path in paths:
+        url = urlsplit(path)
+        if not url.path.startswith('/api/') or url.path == '/api/batch':
+            responses.append({'path': path, 'status': 400, 'body': {'error': 'Unsupported path'}})
+            continue
+        
+        args = dict(parse_qsl(url.query))
+        args.setdefault('telegram_id', telegram_id)
+        
+        with app.test_request_context(url.path, method='GET', query_string=urlencode(args)):
+            try:
+                response = app.make_response(app.dispatch_request())
+            except HTTPException as e:
+                response = app.make_response((jsonify({'error': e.name}), e.code))
+        
+        responses.append({'path': path, 'status': response.status_code, 'body': response.get_json()})
+    
+    return jsonify({'responses': responses})
+
+# Schema setup runs once per deploy (`flask --app app init-db`, which
+# gunicorn.conf.py calls before forking workers) rather than on every import
+@app.cli.command('init-db')
+def init_db_command():
+    """Create or migrate the database tables"""
+    init_db()
+    print('Database initialized')
 
-# Initialize database on startup
-init_db()
+if os.environ.get('RUN_DB_INIT') == '1':
+    init_db()
 
 if __name__ == '__main__':
+    init_db()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -3,28 +3,127 @@ Database initialization and management script
 Run this to reset or inspect your database
 """
 
+import atexit
+import os
 import sqlite3
+import sys
 from datetime import datetime
 
 DATABASE = 'finance.db'
 
+# Separator lines used by view_database
+BANNER = "=" * 50
+RULE = "-" * 50
+
+# One expense's lines, filled from (id, amount, category, source, note, date);
+# the trailing newline leaves a blank line between expenses
+EXPENSE_ROW = "ID: {0}, Amount: ${1:.2f}, Category: {2}\n   Source: {3}, Note: {4}\n   Date: {5}\n".format
+
+# Same journal settings as the app; busy_timeout waits out a running app's writes
+PRAGMAS = (
+    'journal_mode=WAL',
+    'synchronous=NORMAL',
+    'temp_store=MEMORY',
+    'cache_size=-65536',
+    'busy_timeout=5000',
+)
+
+# Statements run on every seed/view, kept identical so the connection's
+# statement cache reuses their compiled form
+# Returns the user's id whether the row is new or already existed
+SQL_UPSERT_USER = '''
+    INSERT INTO users (telegram_id, username) VALUES (?, ?)
+    ON CONFLICT (telegram_id) DO UPDATE SET username = excluded.username
+    RETURNING id
+'''
+SQL_INSERT_SOURCE = "INSERT INTO money_sources (user_id, name, balance, type) VALUES (?, ?, ?, ?)"
+SQL_INSERT_EXPENSE = '''
+    INSERT INTO expenses (user_id, source_id, amount, category, note, source_name, source_type)
+    SELECT ?, id, ?, ?, ?, name, type FROM money_sources WHERE id = ?
+'''
+# Debits each source by its expenses with an id above the given one
+SQL_DEBIT_SOURCES = '''
+    UPDATE money_sources
+    SET balance = balance - (
+        SELECT SUM(amount) FROM expenses
+        WHERE expenses.source_id = money_sources.id AND expenses.id > ?
+    )
+    WHERE id IN (SELECT source_id FROM expenses WHERE id > ?)
+'''
+# Each count can be answered from the smallest index on its table
+SQL_COUNT_ALL = '''
+    SELECT (SELECT COUNT(*) FROM users),
+           (SELECT COUNT(*) FROM money_sources),
+           (SELECT COUNT(*) FROM expenses)
+'''
+# Columns in EXPENSE_ROW order
+SQL_SELECT_EXPENSES = '''
+    SELECT e.id, e.amount, e.category, ms.name, e.note, e.created_at
+    FROM expenses e
+    JOIN money_sources ms ON e.source_id = ms.id
+    ORDER BY e.created_at DESC
+'''
+
+def _connect():
+    """Open the database with the PRAGMAs above applied"""
+    # A larger statement cache keeps every query this script runs prepared.
+    # isolation_level=None: transactions are only the explicit BEGINs below,
+    # so sqlite3 doesn't inspect each statement to decide whether to open one
+    conn = sqlite3.connect(DATABASE, cached_statements=256, isolation_level=None)
+    for pragma in PRAGMAS:
+        conn.execute(f'PRAGMA {pragma}')
+    return conn
+
+# One connection shared by every menu action until the script exits
+_CONN = None
+
+def get_conn():
+    """Return the shared connection, opening it on first use"""
+    global _CONN
+    if _CONN is None:
+        _CONN = _connect()
+    return _CONN
+
+def close_conn(optimize=True):
+    """Close the shared connection, refreshing planner statistics first"""
+    global _CONN
+    if _CONN is not None:
+        if optimize:
+            # Re-analyzes only tables that changed enough to need it
+            try:
+                _CONN.execute('PRAGMA optimize')
+            except sqlite3.Error:
+                pass
+        _CONN.close()
+        _CONN = None
+
+# Also covers exits that skip the menu's "Exit" (Ctrl+C, errors)
+atexit.register(close_conn)
+
 def create_tables():
     """Create all database tables"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_conn()
     cursor = conn.cursor()
     
     print("Creating tables...")
     
+    # Status lines are printed together once the transaction has committed
+    status = []
+    
+    # One transaction for all DDL (sqlite3 would otherwise autocommit each CREATE)
+    cursor.execute('BEGIN')
+    
     # Users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             telegram_id INTEGER UNIQUE NOT NULL,
             username TEXT,
+            data_version INTEGER NOT NULL DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    print("✓ Users table created")
+    status.append("✓ Users table created")
     
     # Money sources table
     cursor.execute('''
@@ -38,7 +137,7 @@ def create_tables():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
-    print("✓ Money sources table created")
+    status.append("✓ Money sources table created")
     
     # Expenses table
     cursor.execute('''
@@ -49,31 +148,43 @@ def create_tables():
             amount REAL NOT NULL,
             category TEXT NOT NULL,
             note TEXT,
+            source_name TEXT,
+            source_type TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id),
             FOREIGN KEY (source_id) REFERENCES money_sources (id)
         )
     ''')
-    print("✓ Expenses table created")
+    status.append("✓ Expenses table created")
+    
+    # The first, second and last match app.init_db's SQLite indexes, so either
+    # can create them first; idx_expenses_created_at (for view_database's
+    # ORDER BY) exists only here on SQLite, the app creates it on Postgres
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_created ON expenses(user_id, created_at DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_source ON expenses(user_id, source_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_created_at ON expenses(created_at DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sources_user_id ON money_sources(user_id)')
+    status.append("✓ Indexes created")
     
     conn.commit()
-    conn.close()
+    print("\n".join(status))
     print("\nDatabase setup complete!")
 
 def add_sample_data():
     """Add sample data for testing"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_conn()
     cursor = conn.cursor()
     
     print("\nAdding sample data...")
     
+    status = []
+    
+    # Everything below commits (and syncs to disk) once, at the end
+    cursor.execute('BEGIN')
+    
     # Add test user
-    cursor.execute('''
-        INSERT OR IGNORE INTO users (telegram_id, username)
-        VALUES (123456789, 'testuser')
-    ''')
-    user_id = cursor.lastrowid or 1
-    print(f"✓ Test user created (ID: {user_id})")
+    user_id = cursor.execute(SQL_UPSERT_USER, (123456789, 'testuser')).fetchone()[0]
+    status.append(f"✓ Test user created (ID: {user_id})")
     
     # Add sample money sources
     sources = [
@@ -82,12 +193,11 @@ def add_sample_data():
         ('PayPal', 750.00, 'paypal')
     ]
     
-    for name, balance, source_type in sources:
-        cursor.execute('''
-            INSERT INTO money_sources (user_id, name, balance, type)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, name, balance, source_type))
-    print(f"✓ Added {len(sources)} money sources")
+    # executemany in one transaction is the bulk-load path: each statement is
+    # compiled once and rebound per row; generators keep the parameter rows
+    # from being copied into a second list, however large the seed grows
+    cursor.executemany(SQL_INSERT_SOURCE, ((user_id, name, balance, source_type) for name, balance, source_type in sources))
+    status.append(f"✓ Added {len(sources)} money sources")
     
     # Add sample expenses
     expenses = [
@@ -97,87 +207,84 @@ def add_sample_data():
         (3, 30.00, 'Entertainment', 'Movie tickets')
     ]
     
-    for source_id, amount, category, note in expenses:
-        cursor.execute('''
-            INSERT INTO expenses (user_id, source_id, amount, category, note)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, source_id, amount, category, note))
-        
-        # Update source balance
-        cursor.execute('''
-            UPDATE money_sources 
-            SET balance = balance - ? 
-            WHERE id = ?
-        ''', (amount, source_id))
+    last_expense_id = cursor.execute('SELECT COALESCE(MAX(id), 0) FROM expenses').fetchone()[0]
+    cursor.executemany(SQL_INSERT_EXPENSE, ((user_id, amount, category, note, source_id) for source_id, amount, category, note in expenses))
+    
+    # Update source balances in one statement, counting only the expenses just added
+    cursor.execute(SQL_DEBIT_SOURCES, (last_expense_id, last_expense_id))
     
-    print(f"✓ Added {len(expenses)} sample expenses")
+    status.append(f"✓ Added {len(expenses)} sample expenses")
     
     conn.commit()
-    conn.close()
+    print("\n".join(status))
     print("\nSample data added successfully!")
 
 def view_database():
     """View current database contents"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    conn = get_conn()
     cursor = conn.cursor()
     
-    print("\n" + "="*50)
-    print("DATABASE CONTENTS")
-    print("="*50)
+    # Lines are collected here and written to stdout once at the end
+    out = [BANNER, "DATABASE CONTENTS", BANNER]
+    append = out.append
+    
+    # Each section prints a COUNT(*) header, then streams rows off the cursor
+    # instead of building a list of them. Rows are plain tuples in the order of
+    # each SELECT's column list.
+    
+    # All reads share one read transaction (and so one consistent snapshot)
+    cursor.execute('BEGIN DEFERRED')
+    
+    user_count, source_count, expense_count = cursor.execute(SQL_COUNT_ALL).fetchone()
     
     # Users
-    cursor.execute('SELECT * FROM users')
-    users = cursor.fetchall()
-    print(f"\n📊 USERS ({len(users)} total):")
-    print("-" * 50)
-    for user in users:
-        print(f"ID: {user['id']}, Telegram ID: {user['telegram_id']}, Username: {user['username']}")
+    out.append(f"\n📊 USERS ({user_count} total):")
+    out.append(RULE)
+    for user in cursor.execute('SELECT id, telegram_id, username FROM users'):
+        append(f"ID: {user[0]}, Telegram ID: {user[1]}, Username: {user[2]}")
     
     # Money Sources
-    cursor.execute('SELECT * FROM money_sources')
-    sources = cursor.fetchall()
-    print(f"\n💰 MONEY SOURCES ({len(sources)} total):")
-    print("-" * 50)
-    for source in sources:
-        print(f"ID: {source['id']}, Name: {source['name']}, Balance: ${source['balance']:.2f}, Type: {source['type']}")
+    out.append(f"\n💰 MONEY SOURCES ({source_count} total):")
+    out.append(RULE)
+    for source in cursor.execute('SELECT id, name, balance, type FROM money_sources'):
+        append(f"ID: {source[0]}, Name: {source[1]}, Balance: ${source[2]:.2f}, Type: {source[3]}")
     
     # Expenses
-    cursor.execute('''
-        SELECT e.*, ms.name as source_name 
-        FROM expenses e
-        JOIN money_sources ms ON e.source_id = ms.id
-        ORDER BY e.created_at DESC
-    ''')
-    expenses = cursor.fetchall()
-    print(f"\n💳 EXPENSES ({len(expenses)} total):")
-    print("-" * 50)
-    for expense in expenses:
-        print(f"ID: {expense['id']}, Amount: ${expense['amount']:.2f}, Category: {expense['category']}")
-        print(f"   Source: {expense['source_name']}, Note: {expense['note']}")
-        print(f"   Date: {expense['created_at']}")
-        print()
+    out.append(f"\n💳 EXPENSES ({expense_count} total):")
+    out.append(RULE)
+    for expense in cursor.execute(SQL_SELECT_EXPENSES):
+        append(EXPENSE_ROW(*expense))
     
-    conn.close()
+    conn.commit()
+    
+    sys.stdout.write("\n" + "\n".join(out) + "\n")
 
 def reset_database():
     """Delete all data and recreate tables"""
-    response = input("\n⚠️  WARNING: This will delete ALL data. Continue? (yes/no): ")
+    response = input("\n⚠️  WARNING: This will delete ALL data. Stop the app first. Continue? (yes/no): ")
     if response.lower() != 'yes':
         print("Reset cancelled.")
         return
     
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
     print("\nResetting database...")
-    cursor.execute('DROP TABLE IF EXISTS expenses')
-    cursor.execute('DROP TABLE IF EXISTS money_sources')
-    cursor.execute('DROP TABLE IF EXISTS users')
-    print("✓ Old tables dropped")
     
-    conn.commit()
-    conn.close()
+    # Deleting the file (and its WAL/shared-memory files) is cheaper than
+    # dropping each table's pages one by one
+    close_conn(optimize=False)
+    
+    # SQLite removes the -wal/-shm files when the last connection closes, so if
+    # either is still here another process (the app) has the database open and
+    # would keep writing into the deleted file
+    if os.path.exists(DATABASE + '-wal') or os.path.exists(DATABASE + '-shm'):
+        print("✗ The database is still open in another process. Stop the app and try again.")
+        return
+    
+    for path in (DATABASE, DATABASE + '-wal', DATABASE + '-shm'):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    print("✓ Old database deleted")
     
     create_tables()
     print("\n✓ Database reset complete!")
@@ -206,6 +313,7 @@ def main():
         elif choice == '4':
             reset_database()
         elif choice == '5':
+            close_conn()
             print("\nGoodbye!")
             break
         else:
@@ -0,0 +1,30 @@
+"""
+Gunicorn settings, picked up automatically by `gunicorn app:app`
+"""
+
+import os
+import subprocess
+import sys
+
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+worker_class = 'sync'
+
+# With Postgres every request waits on the network, so use gevent workers that
+# switch to another request while a query is in flight. Each worker serves at
+# most DB_POOL_MAX requests at once so the connection pool is never exhausted.
+if DATABASE_URL.startswith('postgres'):
+    worker_class = 'gevent'
+    worker_connections = int(os.environ.get('DB_POOL_MAX', 20))
+
+def on_starting(server):
+    """Create/migrate the schema once, before any worker imports the app"""
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], check=True)
+
+def post_fork(server, worker):
+    """Make psycopg2 yield to gevent while waiting on the database"""
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()